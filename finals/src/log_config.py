@@ -0,0 +1,202 @@
+"""Queued logging for the servers.
+
+Records are formatted by the caller, put on a bounded in-memory queue and
+written out by a background thread, so the asyncio loop doesn't wait on
+stdout/stderr. When the queue is full, records below WARNING are dropped at
+once, while WARNING and worse wait up to `LOG_BLOCK_TIMEOUT` for space. The same
+module is copied into `finals/src` and `test_competition_server/src`, since
+each is built as its own Docker image; keep the two copies in sync.
+
+Behaviour is controlled with environment variables:
+- `LOG_LEVEL`: minimum level to log (default `INFO`).
+- `LOG_SAMPLE_RATE`: fraction of sub-WARNING records to keep (default `1.0`).
+- `LOG_MAX_PAYLOAD_CHARS`: max length of payloads wrapped in `truncate`.
+- `LOG_QUEUE_SIZE`: records buffered before sub-WARNING ones are dropped.
+"""
+
+import atexit
+import contextlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from time import monotonic
+from typing import Any
+
+LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE: float = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+LOG_MAX_PAYLOAD_CHARS: int = int(os.environ.get("LOG_MAX_PAYLOAD_CHARS", "256"))
+LOG_QUEUE_SIZE: int = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# how long a WARNING or worse record may wait for space in a full queue
+LOG_BLOCK_TIMEOUT: float = 0.1
+# min seconds between reports of dropped records
+LOG_DROP_REPORT_INTERVAL: float = 10.0
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listeners: dict[str, "DrainingQueueListener"] = {}
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a random fraction of records below WARNING."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that sheds low-priority records when the queue is full.
+
+    Records below WARNING are dropped straight away; WARNING and worse wait
+    briefly for space and are only dropped if the listener is badly behind.
+    Drops are counted and reported on stderr, at most once per
+    `LOG_DROP_REPORT_INTERVAL` and when the listener stops.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.reported = 0
+        self.last_report = 0.0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # uvicorn's access log formatter reads record.args, so those records
+        # are passed through as-is and formatted on the background thread.
+        # Everything else is rendered now, as the stock handler does, so
+        # mutable args can't change before the listener gets to them.
+        if record.name == "uvicorn.access":
+            return record
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=LOG_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if (
+            self.dropped > self.reported
+            and monotonic() - self.last_report >= LOG_DROP_REPORT_INTERVAL
+        ):
+            self.report_dropped()
+
+    def report_dropped(self):
+        """Reports records dropped since the last report, bypassing the queue."""
+        if self.dropped == self.reported:
+            return
+        record = logging.makeLogRecord(
+            {
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Dropped %d log records because the log queue was full",
+                "args": (self.dropped - self.reported,),
+            }
+        )
+        self.reported = self.dropped
+        self.last_report = monotonic()
+        # lastResort writes straight to stderr, so this works even if the
+        # listener is stuck or already stopped
+        logging.lastResort.handle(record)
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() waits for space instead of failing on a full queue."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class truncate:
+    """Lazily renders `obj`, cut down to at most `limit` characters.
+
+    Rendering only happens if the record is actually emitted, so wrapping a
+    large payload costs nothing when its level is disabled or it is sampled out.
+    """
+
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj: Any, limit: int = LOG_MAX_PAYLOAD_CHARS):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.obj if isinstance(self.obj, str) else repr(self.obj)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... <{len(text) - self.limit} more chars>"
+
+
+def setup_logging(name: str | None = None, level: str = LOG_LEVEL) -> logging.Logger:
+    """Moves the handlers of logger `name` onto a background thread.
+
+    Existing handlers (e.g. those installed by uvicorn) are kept and fed from
+    the queue; a plain stream handler is used if there are none. Calling this
+    more than once for the same logger is a no-op.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    key = logger.name
+    if key in _listeners:
+        return logger
+
+    handlers = logger.handlers[:]
+    if not handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = [stream_handler]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    logger.addHandler(queue_handler)
+
+    listener = DrainingQueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+
+    def stop():
+        listener.stop()
+        queue_handler.report_dropped()
+
+    atexit.register(stop)
+    _listeners[key] = listener
+    return logger
+
+
+def silence(*names: str, level: int = logging.WARNING):
+    """Raises the level of chatty third-party loggers (e.g. per-request httpx logs)."""
+    for name in names:
+        logging.getLogger(name).setLevel(level)
+
+
+class _NullWriter:
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences third-party code that writes progress chatter to stdout.
+
+    This replaces `sys.stdout` for the whole process, so it isn't thread-safe:
+    callers running it in threads must not overlap.
+    """
+    with contextlib.redirect_stdout(_NullWriter()):
+        yield
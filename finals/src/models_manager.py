@@ -1,15 +1,18 @@
 import json
+import logging
 from base64 import b64encode
 from typing import Any
 
 import httpx
 import websockets
 
+logger = logging.getLogger(__name__)
+
 
 class ModelsManager:
     def __init__(self, local_ip: str):
         self.local_ip = local_ip
-        print("initializing participant finals server manager")
+        logger.info("initializing participant finals server manager")
         self.client = httpx.AsyncClient()
 
     async def exit(self):
@@ -24,7 +27,7 @@ class ModelsManager:
         return await websocket.send(json.dumps(data))
 
     async def run_asr(self, audio_b64: str) -> str:
-        print("Running ASR")
+        logger.info("Running ASR")
         results = await self.async_post(
             f"http://{self.local_ip}:5001/asr",
             json={"instances": [{"b64": audio_b64}]},
@@ -32,7 +35,7 @@ class ModelsManager:
         return results.json()["predictions"][0]
 
     async def run_cv(self, image_b64: str) -> list[int]:
-        print("Running CV")
+        logger.info("Running CV")
         results = await self.async_post(
             f"http://{self.local_ip}:5002/cv",
             json={"instances": [{"b64": image_b64}]},
@@ -40,7 +43,7 @@ class ModelsManager:
         return results.json()["predictions"][0]
 
     async def run_ocr(self, image_b64: str) -> str:
-        print("Running OCR")
+        logger.info("Running OCR")
         results = await self.async_post(
             f"http://{self.local_ip}:5003/ocr",
             json={"instances": [{"b64": image_b64}]},
@@ -48,7 +51,7 @@ class ModelsManager:
         return results.json()["predictions"][0]
 
     async def run_rl(self, observation: dict[str, int | list[int]]) -> int:
-        print("Running RL")
+        logger.info("Running RL")
         results = await self.async_post(
             f"http://{self.local_ip}:5004/rl",
             json={"instances": [{"observation": observation}]},
@@ -56,7 +59,7 @@ class ModelsManager:
         return results.json()["predictions"][0]["action"]
 
     async def run_surprise(self, slices: list[str]) -> list[int]:
-        print("Running surprise")
+        logger.info("Running surprise")
         results = await self.async_post(
             f"http://{self.local_ip}:5005/surprise",
             json={"instances": [{"slices": slices}]},
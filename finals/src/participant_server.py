@@ -1,16 +1,24 @@
 import asyncio
 import json
 import os
-import traceback
 from urllib.parse import quote
 
 import websockets
+from log_config import setup_logging, silence, truncate
 from models_manager import ModelsManager
+from session import Session
 
 TEAM_NAME = os.environ["TEAM_NAME"]
 LOCAL_IP = os.environ["LOCAL_IP"]
 SERVER_IP = os.environ["COMPETITION_SERVER_IP"]
 SERVER_PORT = os.environ["COMPETITION_SERVER_PORT"]
+# Optional, to join a specific match on a server hosting several
+MATCH_ID = os.environ.get("MATCH_ID")
+
+# Route all logging (including models_manager) through a background thread
+logger = setup_logging()
+# httpx logs every request at INFO, which is one line per model call
+silence("httpx", "httpcore")
 
 manager = ModelsManager(LOCAL_IP)
 
@@ -34,27 +42,25 @@ async def task_handler(data: dict) -> None:
             raise ValueError(f"Unknown task type {repr(data['task'])}")
 
 
-async def handle_task_and_send_result(websocket, data: dict):
-    """Handle a task and send the result when complete"""
-    try:
-        result = await task_handler(data)
-        await manager.send_result(websocket, {"task": data["task"], "result": result})
-    except Exception as e:
-        print(f"Error handling task {data.get('task', 'unknown')}: {e}")
-        traceback.print_exception(e)
-
-
 async def server():
+    # Outlives each connection, so running tasks survive a reconnect
+    session = Session(manager.send_result)
+
     async for websocket in websockets.connect(
-        quote(f"ws://{SERVER_IP}:{SERVER_PORT}/ws/{TEAM_NAME}", safe="/:"),
+        quote(
+            f"ws://{SERVER_IP}:{SERVER_PORT}/ws/"
+            + (f"{MATCH_ID}/{TEAM_NAME}" if MATCH_ID else TEAM_NAME),
+            safe="/:",
+        ),
         max_size=2**24,
     ):
-        print(f"connecting to competition server {SERVER_IP} at port {SERVER_PORT}")
-
-        # Keep track of running tasks so we can clean them up if needed
-        running_tasks: set[asyncio.Task] = set()
+        logger.info(
+            f"connecting to competition server {SERVER_IP} at port {SERVER_PORT}"
+        )
 
         try:
+            # Send any results that finished while we were disconnected
+            await session.attach(websocket)
             while True:
                 # Receive json data from server
                 socket_input = await websocket.recv()
@@ -62,27 +68,15 @@ async def server():
                     data = json.loads(socket_input)
                     match data["type"]:
                         case "task":
-                            # Create task and add to running tasks set
-                            task = asyncio.create_task(
-                                handle_task_and_send_result(websocket, data)
-                            )
-                            running_tasks.add(task)
-
-                            # Remove completed tasks from the set to prevent memory leaks
-                            task.add_done_callback(running_tasks.discard)
+                            # Run the task in the background and send its result when complete
+                            session.start_task(data, task_handler)
 
                         case "done":
                             # Handle done update
-                            print("done!")
+                            logger.info("done!")
 
                             # Wait for all running tasks to complete before breaking
-                            if running_tasks:
-                                print(
-                                    f"Waiting for {len(running_tasks)} tasks to complete..."
-                                )
-                                await asyncio.gather(
-                                    *running_tasks, return_exceptions=True
-                                )
+                            await session.wait()
                             await manager.exit()
                             break
 
@@ -90,33 +84,36 @@ async def server():
                             await manager.send_result(websocket, {"health": "ok"})
 
                         case _:
-                            print(
-                                f"received invalid text data of type {data['type']}:",
-                                data,
-                                sep="\n",
+                            logger.warning(
+                                "received invalid text data of type %s:\n%s",
+                                data["type"],
+                                truncate(data),
                             )
                 else:
-                    print(f"received invalid data of type {type(socket_input)}")
+                    logger.warning(
+                        f"received invalid data of type {type(socket_input)}"
+                    )
 
         except websockets.ConnectionClosed:
-            # Cancel any running tasks when connection is lost
-            await shutdown(running_tasks, manager)
+            # Keep running tasks going; their results are sent after reconnecting
+            logger.info("connection lost, reconnecting")
+            session.detach()
             continue
         except KeyboardInterrupt:
             # Cancel running tasks on keyboard interrupt
-            await shutdown(running_tasks, manager)
+            await shutdown(session, manager)
             break
         except Exception as e:
-            traceback.print_exception(e)
+            logger.exception(e)
             # Cancel running tasks on unexpected errors
-            await shutdown(running_tasks, manager)
+            await shutdown(session, manager)
         else:
             break
 
 
-async def shutdown(running_tasks: set[asyncio.Task], manager: ModelsManager):
-    for task in running_tasks:
-        task.cancel()
+async def shutdown(session: Session, manager: ModelsManager):
+    session.detach()
+    session.cancel()
     # return await manager.exit()
 
 
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from collections.abc import Awaitable, Callable
+from time import monotonic
+from typing import Any
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# max results kept while disconnected; the oldest is dropped when full
+RESUME_BUFFER_SIZE: int = int(os.environ.get("RESUME_BUFFER_SIZE", "32"))
+# seconds a buffered result stays worth sending after it was produced
+RESUME_TTL: float = float(os.environ.get("RESUME_TTL", "10.0"))
+
+SCOUT_TASKS = ("asr", "cv", "ocr", "surprise")
+
+
+class BufferedResult:
+    __slots__ = ("created", "task_id", "message")
+
+    def __init__(self, task_id: int, message: dict[str, Any]):
+        self.created = monotonic()
+        self.task_id = task_id
+        self.message = message
+
+
+def is_rl(buffered: BufferedResult) -> bool:
+    return buffered.message["task"] == "rl"
+
+
+class Session:
+    """Keeps model tasks and their results alive across websocket reconnects.
+
+    Tasks run independently of the connection they arrived on. A result that
+    can't be sent because the connection dropped is buffered and sent on the
+    next connection, as long as it hasn't expired and is still current: an
+    RL result must be for the latest observed step, and a scout result for
+    the latest scout task received.
+
+    Scout results are flushed as soon as a connection is attached. Buffered RL
+    results are held until the first observation arrives on the new
+    connection, since only then is the server's current step known.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[websockets.ClientConnection, dict], Awaitable[Any]],
+        max_buffered: int = RESUME_BUFFER_SIZE,
+        ttl: float = RESUME_TTL,
+    ):
+        self.send = send
+        self.ttl = ttl
+        self.websocket: websockets.ClientConnection | None = None
+        self.running_tasks: set[asyncio.Task] = set()
+        self.buffer: deque[BufferedResult] = deque(maxlen=max_buffered)
+        self.next_task_id = 0
+        self.latest_rl_step: int | None = None
+        self.latest_scout_task_id: int | None = None
+        self.dropped = 0
+        # flushes replace self.buffer, so only one may run at a time
+        self.flush_lock = asyncio.Lock()
+
+    def start_task(
+        self, data: dict, run: Callable[[dict], Awaitable[Any]]
+    ) -> asyncio.Task:
+        """Runs `run(data)` in the background and delivers its result."""
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        if data["task"] == "rl":
+            self.latest_rl_step = data["observation"]["step"]
+            if any(is_rl(buffered) for buffered in self.buffer):
+                self.track(asyncio.create_task(self.flush_rl()))
+        elif data["task"] in SCOUT_TASKS:
+            self.latest_scout_task_id = task_id
+
+        return self.track(asyncio.create_task(self.run_task(task_id, data, run)))
+
+    def track(self, task: asyncio.Task) -> asyncio.Task:
+        self.running_tasks.add(task)
+        # Remove completed tasks from the set to prevent memory leaks
+        task.add_done_callback(self.running_tasks.discard)
+        return task
+
+    async def run_task(
+        self, task_id: int, data: dict, run: Callable[[dict], Awaitable[Any]]
+    ):
+        try:
+            result = await run(data)
+            await self.deliver(task_id, {"task": data["task"], "result": result})
+        except Exception as e:
+            logger.exception(f"Error handling task {data.get('task', 'unknown')}: {e}")
+
+    async def deliver(self, task_id: int, message: dict):
+        if self.websocket is not None:
+            try:
+                await self.send(self.websocket, message)
+                return
+            except websockets.ConnectionClosed:
+                pass
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(BufferedResult(task_id, message))
+        logger.info(f"Buffered {message['task']} result until reconnected")
+
+    def is_current(self, buffered: BufferedResult) -> bool:
+        if monotonic() - buffered.created > self.ttl:
+            return False
+        match buffered.message["task"]:
+            case "rl":
+                return buffered.message["result"]["step"] == self.latest_rl_step
+            case task if task in SCOUT_TASKS:
+                return buffered.task_id == self.latest_scout_task_id
+        return True
+
+    async def flush(
+        self,
+        websocket: websockets.ClientConnection,
+        selected: Callable[[BufferedResult], bool],
+    ):
+        """Sends the `selected` buffered results that are still current."""
+        async with self.flush_lock:
+            await self._flush(websocket, selected)
+
+    async def _flush(
+        self,
+        websocket: websockets.ClientConnection,
+        selected: Callable[[BufferedResult], bool],
+    ):
+        kept: deque[BufferedResult] = deque(maxlen=self.buffer.maxlen)
+        sent = 0
+        while self.buffer:
+            buffered = self.buffer.popleft()
+            if not selected(buffered):
+                kept.append(buffered)
+                continue
+            if not self.is_current(buffered):
+                self.dropped += 1
+                continue
+            try:
+                await self.send(websocket, buffered.message)
+            except websockets.ConnectionClosed:
+                # keep the rest for the next connection
+                kept.append(buffered)
+                kept.extend(self.buffer)
+                self.buffer = kept
+                raise
+            sent += 1
+        self.buffer = kept
+        if sent or self.dropped:
+            logger.info(
+                f"Resumed session: sent {sent} buffered results, {self.dropped} dropped so far"
+            )
+
+    async def attach(self, websocket: websockets.ClientConnection):
+        """Uses `websocket` from now on and flushes buffered scout results."""
+        self.websocket = websocket
+        await self.flush(websocket, lambda buffered: not is_rl(buffered))
+
+    async def flush_rl(self):
+        if self.websocket is None:
+            return
+        try:
+            await self.flush(self.websocket, is_rl)
+        except websockets.ConnectionClosed:
+            pass
+
+    def detach(self):
+        self.websocket = None
+
+    async def wait(self):
+        """Waits for all running tasks to complete."""
+        if self.running_tasks:
+            logger.info(f"Waiting for {len(self.running_tasks)} tasks to complete...")
+            await asyncio.gather(*self.running_tasks, return_exceptions=True)
+
+    def cancel(self):
+        for task in self.running_tasks:
+            task.cancel()
@@ -0,0 +1,158 @@
+"""Memory-mapped cache of the per-image CV annotation index.
+
+Parsing the full `annotations.json` on every start is slow, so the grouped
+per-image annotations are written once to a compact binary file and then
+memory-mapped on later starts. Only the annotations for an image that
+actually gets scored are ever decoded.
+
+File layout (little-endian):
+- header: magic, version, source mtime_ns, source size, source sha256,
+  image count, categories offset and length, CRC-32 of everything after
+  the header
+- index: one (image_id, offset, length) record per image, sorted by id
+- blobs: one JSON blob per image (`images` + `annotations`), then the
+  shared categories blob
+
+The cache is reused while the source file's mtime and size are unchanged.
+If either differs, the source is hashed; a matching hash just refreshes the
+stored mtime, otherwise the cache is rebuilt. A cache whose body doesn't
+match its CRC is rebuilt too.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("uvicorn.error")
+
+MAGIC = b"TILCVIDX"
+VERSION = 2
+HEADER = struct.Struct("<8sIqq32sQQQI")
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<u8"), ("length", "<u8")])
+# offset of the source mtime_ns field within the header
+MTIME_OFFSET = struct.calcsize("<8sI")
+
+
+def _hash_file(path: Path) -> bytes:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").digest()
+
+
+def _build(source: Path, mtime_ns: int, size: int, digest: bytes) -> bytes:
+    with open(source) as f:
+        raw = json.load(f)
+
+    images = {img_info["id"]: img_info for img_info in raw["images"]}
+    anns: dict[int, list] = {img_id: [] for img_id in images}
+    for ann_info in raw["annotations"]:
+        anns.setdefault(ann_info["image_id"], []).append(ann_info)
+
+    ids = sorted(images)
+    blobs = [
+        json.dumps(
+            {"images": [images[img_id]], "annotations": anns[img_id]},
+            separators=(",", ":"),
+        ).encode()
+        for img_id in ids
+    ]
+    categories = json.dumps(raw["categories"], separators=(",", ":")).encode()
+
+    index = np.empty(len(ids), dtype=INDEX_DTYPE)
+    offset = HEADER.size + index.nbytes
+    for i, (img_id, blob) in enumerate(zip(ids, blobs)):
+        index[i] = (img_id, offset, len(blob))
+        offset += len(blob)
+
+    body = b"".join([index.tobytes(), *blobs, categories])
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        mtime_ns,
+        size,
+        digest,
+        len(ids),
+        offset,
+        len(categories),
+        zlib.crc32(body),
+    )
+    return header + body
+
+
+class AnnotationIndex:
+    """Per-image lookup over a cached annotation file (or in-memory buffer)."""
+
+    def __init__(self, buffer: bytes | mmap.mmap):
+        self.buffer = buffer
+        *_, count, cats_offset, cats_length, crc = HEADER.unpack_from(buffer)
+        if len(buffer) != cats_offset + cats_length:
+            raise ValueError("Annotation cache is truncated")
+        # checked up front so a corrupt blob can't fail scoring later on
+        with memoryview(buffer) as view:
+            if zlib.crc32(view[HEADER.size :]) != crc:
+                raise ValueError("Annotation cache is corrupt")
+        self.index = np.frombuffer(
+            buffer, dtype=INDEX_DTYPE, count=count, offset=HEADER.size
+        )
+        self.categories = json.loads(
+            buffer[cats_offset : cats_offset + cats_length]
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, img_id: int) -> dict:
+        i = np.searchsorted(self.index["id"], img_id)
+        if i >= len(self.index) or self.index["id"][i] != img_id:
+            raise KeyError(img_id)
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        annotations = json.loads(self.buffer[offset : offset + length])
+        annotations["categories"] = self.categories
+        return annotations
+
+    @classmethod
+    def load(cls, source: Path, cache_path: Path) -> "AnnotationIndex":
+        """Loads the index for `source`, (re)building `cache_path` if it is stale."""
+        stat = source.stat()
+        digest = None
+        try:
+            with open(cache_path, "r+b") as f:
+                header = HEADER.unpack(f.read(HEADER.size))
+                magic, version, mtime_ns, size, cached_digest = header[:5]
+                if magic == MAGIC and version == VERSION:
+                    if mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+                        digest = _hash_file(source)
+                        if digest == cached_digest:
+                            # touched but unchanged, so just refresh the mtime
+                            f.seek(MTIME_OFFSET)
+                            f.write(struct.pack("<q", stat.st_mtime_ns))
+                            f.flush()
+                            mtime_ns, size = stat.st_mtime_ns, stat.st_size
+                    if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+                        return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, struct.error, ValueError):
+            # missing, truncated or corrupt cache (ValueError covers a bad CRC
+            # and bad JSON)
+            pass
+
+        logger.info(f"Building CV annotation cache at {cache_path}")
+        buffer = _build(
+            source, stat.st_mtime_ns, stat.st_size, digest or _hash_file(source)
+        )
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".tmp{os.getpid()}")
+            with open(tmp_path, "wb") as f:
+                f.write(buffer)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            logger.warning(
+                f"Could not write CV annotation cache to {cache_path}", exc_info=True
+            )
+        return cls(buffer)
@@ -1,3 +1,4 @@
+import os
 from typing import Final
 
 # Task Handler
@@ -16,3 +17,16 @@ RL_TIME_CUTOFF: Final[float] = 2.0
 NUM_ROUNDS: Final[int] = 4
 # number of items to queue for each special mission
 QUEUE_ITEMS_PER_MISSION: Final[int] = 5
+# number of teams (agents) in a match
+NUM_TEAMS: Final[int] = 4
+# number of worker processes that matches are spread over; matches on the
+# same worker share its event loop, so only matches on different workers
+# step fully in parallel. Each worker loads its own env and annotations, so
+# raise this only when hosting several matches at once
+NUM_MATCH_WORKERS: Final[int] = int(os.environ.get("NUM_MATCH_WORKERS", "1"))
+# max unsent task messages per team before its connection is closed
+SEND_QUEUE_SIZE: Final[int] = 16
+
+# Caching
+# directory for derived data (e.g. the CV annotation index) reused across runs
+ANNOTATION_CACHE_DIR: Final[str] = "../artifacts/cache"
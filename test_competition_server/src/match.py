@@ -0,0 +1,275 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+from collections.abc import Callable
+from pathlib import Path
+from time import time
+
+import constants
+import numpy as np
+from log_config import truncate
+from task_handler import TaskHandler
+from til_environment.gridworld import Action, parallel_env
+
+# Default action, STAY
+DEFAULT_ACTION = Action.STAY.value
+
+logger = logging.getLogger("uvicorn.error")
+
+track: str = os.environ["TEAM_TRACK"]
+
+# Imported lazily to keep startup fast, but before the match starts so the
+# first round end or scout result doesn't pay for it
+LAZY_MODULES = ["imageio", "scoring"]
+
+# send(team_name, message, key) queues a message for a team; see TeamSender.send
+SendFn = Callable[[str, dict, str | None], None]
+
+
+async def preload_lazy_modules():
+    for name in LAZY_MODULES:
+        await asyncio.to_thread(importlib.import_module, name)
+
+
+class Match:
+    """State and game loop for a single match.
+
+    A match never touches websockets directly: outgoing messages go through
+    `send`, and incoming results are passed to `handle_result`, so it can run
+    in a different process from the connections it serves.
+    """
+
+    def __init__(
+        self, match_id: str, team_names: list[str], data_dir: Path, send: SendFn
+    ):
+        self.match_id = match_id
+        self.send = send
+        self.auto_step = True
+        self.in_progress = False
+        self.round = 0
+        self.step_num = 0
+        self.team_names = team_names
+        self.team_agent_mapping = {}
+        self.agent_team_mapping = {}
+        self.observations = None
+        self.connected: set[str] = set()
+
+        self.match_start_time = time()
+        self.match_out_dir = f"../artifacts/match_{self.match_start_time}_{match_id}"
+        os.makedirs(self.match_out_dir, exist_ok=True)
+
+        for team_name, idx in zip(self.team_names, range(len(self.team_names))):
+            agent_id = f"player_{idx}"
+            self.team_agent_mapping[team_name] = agent_id
+            self.agent_team_mapping[agent_id] = team_name
+
+        self.env = parallel_env(
+            env_wrappers=[], render_mode="rgb_array", novice=track == "novice"
+        )
+        self.task_handler = TaskHandler(data_dir)
+        self.frames: list[np.ndarray] = []
+        observations, _ = self.env.reset()
+        self.frames.append(self.env.render())
+        self.observations = observations
+
+        self.match_results = {
+            "match_id": match_id,
+            "teams": self.team_names,
+            "num_rounds": constants.NUM_ROUNDS,
+            "track": track,
+            "rounds": [
+                {"round": i, "steps": [], "scout_results": []}
+                for i in range(constants.NUM_ROUNDS)
+            ],
+        }
+        # Init step-specific variables
+        self.set_default_actions()
+        self.start_times = {team: 0 for team in self.team_names}
+        self.task_start_time = 0
+
+    def update_task(self):
+        return self.task_handler.get_task_data()
+
+    def team_connect(self, team_name: str):
+        self.connected.add(team_name)
+
+    def team_disconnect(self, team_name: str):
+        self.connected.discard(team_name)
+
+    def step_team(self, team_name: str, observation: dict):
+        observation = {
+            k: v if type(v) is int else v.tolist() for k, v in observation.items()
+        }
+        # Keyed so an unsent observation is replaced by the newer one
+        self.send(
+            team_name, {"type": "task", "task": "rl", "observation": observation}, "rl"
+        )
+        self.start_times[team_name] = time()
+
+    def broadcast_teams(self, message: dict):
+        for team_name in self.connected:
+            self.send(team_name, message, None)
+
+    async def run_until_stop(self):
+        if self.round >= constants.NUM_ROUNDS:
+            self.in_progress = False
+            return
+        self.in_progress = True
+        try:
+            await preload_lazy_modules()
+            while self.auto_step and self.round < constants.NUM_ROUNDS:
+                logger.debug(
+                    f"[{self.match_id}] running round {self.round} step {self.step_num}"
+                )
+                await self.step()
+            else:
+                if self.round >= constants.NUM_ROUNDS:
+                    self.broadcast_teams({"type": "done"})
+        finally:
+            # Cleared even if the preload fails, so a later start can retry
+            self.in_progress = False
+
+    def set_default_actions(self):
+        self.actions = {
+            # NOTE: to make the other agents actually do something, replace this line with
+            # agent: self.env.aec_env.action_space(agent).sample()
+            # or some other agent control code
+            agent: DEFAULT_ACTION
+            for agent in self.team_agent_mapping.values()
+        }
+
+    # step
+    async def step(self):
+        try:
+            start_time = time()
+            self.set_default_actions()
+            for team in self.connected:
+                self.step_team(team, self.observations[self.team_agent_mapping[team]])
+            # Sleep until constants.RL_TIME_CUTOFF sec has passed
+            await asyncio.sleep(constants.RL_TIME_CUTOFF - time() + start_time)
+            logger.debug(f"[{self.match_id}] completed in {time() - start_time:.2f}s")
+            # Copy updated actions
+            _actions = self.actions.copy()
+            # Update rewards
+            observations, rewards, terminations, truncations, infos = self.env.step(
+                _actions
+            )
+            if any([info["add_mission"] for info in infos.values()]):
+                to_send = (
+                    len(self.task_handler.queue) == 0 and self.task_handler.can_get_new
+                )
+                # Add additional items to task queue
+                self.task_handler.add_tasks(constants.QUEUE_ITEMS_PER_MISSION)
+                if to_send:
+                    try:
+                        logger.info(f"[{self.match_id}] sending to Scout")
+                        # Send to the Scout
+                        scout = self.agent_team_mapping[self.env.aec_env.scout]
+                        task_data = self.update_task()
+                        if scout in self.connected and task_data is not None:
+                            self.task_start_time = time()
+                            self.send(scout, task_data, None)
+                    except Exception as err:
+                        logger.exception("Error occurred while queueing send task")
+            self.observations = observations
+            self.match_results["rounds"][self.round]["steps"].append(
+                {
+                    "actions": {
+                        k: v if type(v) is int else v.tolist()
+                        for k, v in _actions.items()
+                    },
+                    "rewards": rewards,
+                }
+            )
+            if any(terminations.values()) or any(truncations.values()):
+                logger.info(f"[{self.match_id}] done with round {self.round}")
+                # Save video and results of round in a thread, so other matches
+                # on this worker keep stepping while they're written
+                import imageio
+
+                self.frames.append(self.env.render())
+                frames, self.frames = self.frames, []
+                await asyncio.to_thread(
+                    imageio.mimsave,
+                    f"{self.match_out_dir}/round_{self.round}.mp4",
+                    frames,
+                    fps=20,
+                )
+                await asyncio.to_thread(
+                    Path(f"{self.match_out_dir}/match_results.json").write_text,
+                    json.dumps(self.match_results),
+                )
+
+                # Prepare for next round
+                self.round += 1
+                self.step_num = 0
+                observations, _ = self.env.reset()
+                self.frames.append(self.env.render())
+                self.observations = observations
+                self.task_handler.reset()
+            else:
+                self.step_num += 1
+                self.frames.append(self.env.render())
+        except Exception as e:
+            logger.exception(e)
+            self.auto_step = False
+
+    async def handle_result(self, team_name: str, data: dict):
+        if data["task"] == "rl":
+            elapsed = time() - self.start_times[team_name]
+            logger.debug(f"rl elapsed for {team_name}: {elapsed}")
+            logger.debug("%s", truncate(data))
+            try:
+                # Reject invalid RL returns
+                if self.step_num != data["result"]["step"]:
+                    logger.info(
+                        "Rejecting RL data %s for %s: it should be for step %s",
+                        truncate(data),
+                        team_name,
+                        self.step_num,
+                    )
+                    return
+                if _act := Action(data["result"]["action"]):
+                    self.actions[self.team_agent_mapping[team_name]] = _act.value
+                return
+            except ValueError:
+                logger.info(
+                    "Rejecting RL data %s for %s: invalid action",
+                    truncate(data),
+                    team_name,
+                )
+                return
+        elapsed = time() - self.task_start_time
+        logger.debug(f"elapsed: {elapsed}")
+
+        # Check if this team is meant to be the Scout
+        if self.env.aec_env.scout != self.team_agent_mapping[team_name]:
+            logger.info(
+                "Rejecting %s for team %s: not the Scout!", truncate(data), team_name
+            )
+            return
+
+        # Take the task and send the next one before scoring, so step() can't
+        # send the same task again while this result is being scored
+        task = self.task_handler.pop_task(data)
+        scout_results = self.match_results["rounds"][self.round]["scout_results"]
+        task_data = self.update_task()
+        if task_data is not None and team_name in self.connected:
+            self.task_start_time = time()
+            self.send(team_name, task_data, None)
+
+        # pycocotools/jiwer scoring blocks, so keep it off the event loop
+        score = await asyncio.to_thread(
+            self.task_handler.eval_task_result, task, data, elapsed
+        )
+        scout_results.append(
+            {
+                "data": data,
+                "score": score,
+            }
+        )
+        logger.info(
+            f"[{self.match_id}] Team {team_name} achieved score {score} for task type {data['task']}"
+        )
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import multiprocessing as mp
+from pathlib import Path
+from uuid import uuid4
+
+import constants
+from fastapi import WebSocket, WebSocketDisconnect
+from match_worker import run_worker
+from team_sender import TeamSender
+from websockets.exceptions import ConnectionClosed
+
+logger = logging.getLogger("uvicorn.error")
+
+# spawn rather than fork, since the server process already runs threads
+mp_context = mp.get_context("spawn")
+
+
+class MatchWorker:
+    """Handle to a worker process that runs a shard of the matches."""
+
+    def __init__(self, worker_id: int, data_dir: Path, outbox: mp.Queue):
+        self.worker_id = worker_id
+        self.inbox: mp.Queue = mp_context.Queue()
+        self.num_matches = 0
+        self.process = mp_context.Process(
+            target=run_worker,
+            args=(worker_id, data_dir, self.inbox, outbox),
+            name=f"match-worker-{worker_id}",
+            daemon=True,
+        )
+
+    def command(self, *command):
+        self.inbox.put(command)
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+
+class MatchHandle:
+    """Server-side view of a match: its worker and its teams' connections."""
+
+    def __init__(self, match_id: str, team_names: list[str], worker: MatchWorker):
+        self.match_id = match_id
+        self.team_names = team_names
+        self.worker = worker
+        self.team_connections: dict[str, WebSocket | None] = {
+            name: None for name in self.team_names
+        }
+        # Outbound messages go through a per-team sender so slow teams can't stall the loop
+        self.team_senders: dict[str, TeamSender | None] = {
+            name: None for name in self.team_names
+        }
+
+    def command(self, command: str, *args):
+        self.worker.command(command, self.match_id, *args)
+
+    async def team_connect(self, websocket: WebSocket, team_name: str) -> bool:
+        """Accepts `websocket` for `team_name`, returning whether it was accepted."""
+        if team_name not in self.team_names:
+            await websocket.close(reason=f"Invalid team {team_name}")
+            return False
+        if self.team_connections[team_name] is not None:
+            logger.info(self.team_connections)
+            try:
+                await self.team_connections[team_name].send_json({"type": "health"})
+                _ = await self.team_connections[team_name].receive()
+            except (WebSocketDisconnect, ConnectionClosed, RuntimeError):
+                await self.team_disconnect(team_name, self.team_connections[team_name])
+            else:
+                await websocket.close(
+                    reason=f"There is already a team connected with name {team_name}!"
+                )
+                return False
+        await websocket.accept()
+        self.team_connections[team_name] = websocket
+        self.team_senders[team_name] = TeamSender(
+            team_name, websocket, constants.SEND_QUEUE_SIZE
+        )
+        self.command("connect", team_name)
+        # Print which teams are connected
+        logger.info(f"[{self.match_id}] {self.team_connections}")
+        return True
+
+    async def team_disconnect(
+        self, team_name: str, websocket: WebSocket, message: str = "Disconnected"
+    ):
+        # The team may have reconnected since, in which case the slot holds the
+        # new connection and must be left alone
+        if self.team_connections[team_name] is not websocket:
+            return
+        self.command("disconnect", team_name)
+        # Free the slot before awaiting anything so a reconnect can take it
+        self.team_connections[team_name] = None
+        sender, self.team_senders[team_name] = self.team_senders[team_name], None
+        if sender is not None:
+            await sender.close()
+            logger.info(
+                f"[{self.match_id}] Send stats for team {team_name}: {sender.stats()}"
+            )
+        try:
+            await websocket.close(reason=message)
+        except:
+            pass
+
+    def submit_result(self, team_name: str, data: dict):
+        self.command("result", team_name, data)
+
+    def send(self, team_name: str, message: dict, key: str | None):
+        if (sender := self.team_senders.get(team_name)) is not None:
+            sender.send(message, key)
+
+    def info(self) -> dict:
+        return {
+            "match_id": self.match_id,
+            "worker": self.worker.worker_id,
+            "worker_alive": self.worker.is_alive(),
+            "teams": self.team_names,
+            "connected": [
+                name for name, ws in self.team_connections.items() if ws is not None
+            ],
+            "send_stats": {
+                name: sender.stats()
+                for name, sender in self.team_senders.items()
+                if sender is not None
+            },
+        }
+
+
+class MatchRegistry:
+    """Runs independent matches spread over a pool of worker processes.
+
+    Websockets stay in the server process, which only relays messages; each
+    match's env, task handler and game loop live in its worker, so matches
+    on different workers step in parallel.
+    """
+
+    def __init__(self, num_workers: int, data_dir: Path):
+        self.outbox: mp.Queue = mp_context.Queue()
+        self.workers = [
+            MatchWorker(worker_id, data_dir, self.outbox)
+            for worker_id in range(num_workers)
+        ]
+        self.matches: dict[str, MatchHandle] = {}
+        self.reader: asyncio.Task | None = None
+
+    async def start(self):
+        for worker in self.workers:
+            worker.process.start()
+        self.reader = asyncio.create_task(self.relay_messages())
+        self.reader.add_done_callback(self.log_relay_exit)
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.command("shutdown", None)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.process.join, constants.RL_TIME_CUTOFF)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        # Unblock the reader thread so it can exit
+        self.outbox.put(None)
+        if self.reader is not None:
+            await self.reader
+
+    async def relay_messages(self):
+        while (event := await asyncio.to_thread(self.outbox.get)) is not None:
+            try:
+                _, match_id, team_name, message, key = event
+                if (match := self.matches.get(match_id)) is not None:
+                    match.send(team_name, message, key)
+            except Exception:
+                logger.exception("Error relaying match worker message")
+
+    def log_relay_exit(self, task: asyncio.Task):
+        if task.cancelled():
+            logger.error(
+                "Match worker relay was cancelled; no more messages will be sent"
+            )
+        elif (e := task.exception()) is not None:
+            logger.error(
+                "Match worker relay failed; no more messages will be sent", exc_info=e
+            )
+
+    def create_match(
+        self, team_names: list[str], match_id: str | None = None
+    ) -> MatchHandle:
+        match_id = match_id or uuid4().hex[:8]
+        if match_id in self.matches:
+            raise ValueError(f"Match {match_id} already exists")
+        alive = []
+        for worker in self.workers:
+            if worker.is_alive():
+                alive.append(worker)
+            else:
+                logger.error(
+                    "Match worker %s (pid %s) is not running, exit code %s",
+                    worker.worker_id,
+                    worker.process.pid,
+                    worker.process.exitcode,
+                )
+        if not alive:
+            raise RuntimeError("No match workers are running")
+        # Place the match on the least loaded worker
+        worker = min(alive, key=lambda worker: worker.num_matches)
+        worker.num_matches += 1
+        match = MatchHandle(match_id, team_names, worker)
+        self.matches[match_id] = match
+        match.command("create", team_names)
+        logger.info(f"Created match {match_id} on worker {worker.worker_id}")
+        return match
+
+    async def remove_match(self, match_id: str):
+        match = self.matches.pop(match_id)
+        for team_name, websocket in list(match.team_connections.items()):
+            if websocket is not None:
+                await match.team_disconnect(team_name, websocket, "Match removed")
+        match.command("remove")
+        match.worker.num_matches -= 1
@@ -0,0 +1,122 @@
+"""Entry point for match worker processes.
+
+Each worker hosts any number of matches on its own event loop. It receives
+commands from the server process on `inbox` and reports outgoing team
+messages on the shared `outbox`, both as plain tuples:
+
+inbox:  ("create", match_id, team_names) | ("start", match_id)
+        | ("stop", match_id) | ("remove", match_id)
+        | ("connect", match_id, team_name) | ("disconnect", match_id, team_name)
+        | ("result", match_id, team_name, data) | ("shutdown", None)
+outbox: ("send", match_id, team_name, message, key)
+"""
+
+import asyncio
+import logging
+import multiprocessing as mp
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from log_config import setup_logging
+
+if TYPE_CHECKING:
+    from match import Match, SendFn
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def run_worker(worker_id: int, data_dir: Path, inbox: mp.Queue, outbox: mp.Queue):
+    setup_logging("uvicorn")
+    logger.info(f"match worker {worker_id} started")
+    asyncio.run(serve(data_dir, inbox, outbox))
+
+
+def log_task_error(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()) is not None:
+        logger.exception(e, exc_info=e)
+
+
+def build_match(
+    match_id: str, team_names: list[str], data_dir: Path, send: "SendFn"
+) -> "Match":
+    # Imported on the first match, so neither the server process nor a worker
+    # that hasn't been given a match yet loads the env
+    from match import Match
+
+    return Match(match_id, team_names, data_dir, send)
+
+
+async def serve(data_dir: Path, inbox: mp.Queue, outbox: mp.Queue):
+    matches: dict[str, "Match"] = {}
+    # Commands for matches that are still being built, replayed once they exist
+    pending: dict[str, list[tuple[str, list]]] = {}
+    # Hold references to running matches so they aren't garbage collected
+    running: set[asyncio.Task] = set()
+
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        running.add(task)
+        task.add_done_callback(running.discard)
+        task.add_done_callback(log_task_error)
+
+    def sender(match_id: str):
+        def send(team_name: str, message: dict, key: str | None):
+            outbox.put(("send", match_id, team_name, message, key))
+
+        return send
+
+    async def create(match_id: str, team_names: list[str]):
+        try:
+            # Building a match loads the env and annotations, so do it in a
+            # thread to keep the other matches on this worker stepping
+            matches[match_id] = await asyncio.to_thread(
+                build_match, match_id, team_names, data_dir, sender(match_id)
+            )
+        finally:
+            for command, args in pending.pop(match_id):
+                handle(command, match_id, args)
+
+    def handle(command: str, match_id: str, args: list):
+        if match_id in pending:
+            pending[match_id].append((command, args))
+            return
+        try:
+            if command == "create":
+                pending[match_id] = []
+                spawn(create(match_id, *args))
+                return
+            game = matches.get(match_id)
+            if game is None:
+                logger.info(f"Ignoring {command} for unknown match {match_id}")
+                return
+            match command:
+                case "start":
+                    game.auto_step = True
+                    if not game.in_progress:
+                        spawn(game.run_until_stop())
+                case "stop":
+                    game.auto_step = False
+                case "remove":
+                    game.auto_step = False
+                    del matches[match_id]
+                case "connect":
+                    game.team_connect(*args)
+                case "disconnect":
+                    game.team_disconnect(*args)
+                case "result":
+                    # Scoring can take a while, so don't hold up other commands
+                    spawn(game.handle_result(*args))
+                case _:
+                    logger.error(f"Unknown match worker command {command!r}")
+        except Exception as e:
+            logger.exception(f"[{match_id}] error handling {command}: {e}")
+
+    while True:
+        command, match_id, *args = await asyncio.to_thread(inbox.get)
+        if command == "shutdown":
+            break
+        handle(command, match_id, args)
+
+    for game in matches.values():
+        game.auto_step = False
+    await asyncio.gather(*running, return_exceptions=True)
@@ -0,0 +1,82 @@
+"""Scoring helpers backed by heavy third-party dependencies.
+
+This module is imported lazily by `task_handler` the first time a result is
+scored, so jiwer and pycocotools don't slow down server startup.
+"""
+
+import threading
+from collections import defaultdict
+
+import jiwer
+from log_config import quiet
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+# quiet() swaps the process-wide sys.stdout, so concurrent CV scoring threads
+# would restore each other's stdout out of order; score one at a time
+cv_lock = threading.Lock()
+
+wer_transforms = jiwer.Compose(
+    [
+        jiwer.ToLowerCase(),
+        jiwer.SubstituteRegexes({"-": " "}),
+        jiwer.RemovePunctuation(),
+        jiwer.ReduceToListOfListOfWords(),
+    ]
+)
+
+cer_transforms = jiwer.Compose(
+    [
+        jiwer.SubstituteRegexes({"-": ""}),
+        jiwer.RemoveWhiteSpace(),
+        jiwer.RemoveMultipleSpaces(),
+        jiwer.Strip(),
+        jiwer.ReduceToListOfListOfChars(),
+    ]
+)
+
+
+class COCOPatched(COCO):
+    def __init__(self, annotations):
+        # The varnames here are disgusting, but they're used by other
+        # non-overridden methods so don't touch them.
+        self.dataset, self.anns, self.cats, self.imgs = {}, {}, {}, {}
+        self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
+
+        assert (
+            type(annotations) == dict
+        ), f"Annotation format {type(annotations)} not supported"
+        self.dataset = annotations
+        self.createIndex()
+
+
+def score_asr(ground_truth: str, prediction: str) -> float:
+    word_output = jiwer.process_words(
+        ground_truth,
+        prediction,
+        reference_transform=wer_transforms,
+        hypothesis_transform=wer_transforms,
+    )
+    return 1 - word_output.wer
+
+
+def score_cv(annotations: dict, prediction: list[dict]) -> float:
+    # pycocotools prints progress and the summary table to stdout
+    with cv_lock, quiet():
+        ground_truth = COCOPatched(annotations)
+        results = ground_truth.loadRes(prediction)
+        coco_eval = COCOeval(ground_truth, results, "bbox")
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return coco_eval.stats[0].item()  # mAP@.5:.05:.95
+
+
+def score_ocr(ground_truth: str, prediction: str) -> float:
+    cer = jiwer.cer(
+        ground_truth,
+        prediction,
+        reference_transform=cer_transforms,
+        hypothesis_transform=cer_transforms,
+    )
+    return 1 - cer
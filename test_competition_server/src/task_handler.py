@@ -1,15 +1,15 @@
 import base64
-import json
+import logging
 import random
-from collections import defaultdict, deque
+from collections import deque
 from enum import StrEnum, auto
 from pathlib import Path
 from typing import TypedDict
 
 import constants
-import jiwer
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
+from annotation_cache import AnnotationIndex
+
+logger = logging.getLogger("uvicorn.error")
 
 
 class TaskType(StrEnum):
@@ -41,41 +41,6 @@ class Task(TypedDict):
     index: int
 
 
-wer_transforms = jiwer.Compose(
-    [
-        jiwer.ToLowerCase(),
-        jiwer.SubstituteRegexes({"-": " "}),
-        jiwer.RemovePunctuation(),
-        jiwer.ReduceToListOfListOfWords(),
-    ]
-)
-
-cer_transforms = jiwer.Compose(
-    [
-        jiwer.SubstituteRegexes({"-": ""}),
-        jiwer.RemoveWhiteSpace(),
-        jiwer.RemoveMultipleSpaces(),
-        jiwer.Strip(),
-        jiwer.ReduceToListOfListOfChars(),
-    ]
-)
-
-
-class COCOPatched(COCO):
-    def __init__(self, annotations):
-        # The varnames here are disgusting, but they're used by other
-        # non-overridden methods so don't touch them.
-        self.dataset, self.anns, self.cats, self.imgs = {}, {}, {}, {}
-        self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
-
-        assert (
-            type(annotations) == dict
-        ), f"Annotation format {type(annotations)} not supported"
-        print("Annotations loaded.")
-        self.dataset = annotations
-        self.createIndex()
-
-
 class TaskHandler:
     def __init__(self, data_dir: Path, shuffle: bool = False):
         # filepath to load testcase data from
@@ -84,30 +49,15 @@ class TaskHandler:
         self.shuffle = shuffle
         self.can_get_new = True
 
-        with open(data_dir / "cv" / "annotations.json") as cv_anns_file:
-            cv_anns_raw = json.load(cv_anns_file)
-
-        self.cv_img_info = {}
-        for img_info in cv_anns_raw["images"]:
-            self.cv_img_info[img_info["id"]] = img_info
-
-        self.cv_ann_info = {}
-        for ann_info in cv_anns_raw["annotations"]:
-            img_id = ann_info["image_id"]
-            if img_id not in self.cv_ann_info:
-                self.cv_ann_info[img_id] = []
-            self.cv_ann_info[img_id].append(ann_info)
-
-        self.cv_categories = cv_anns_raw["categories"]
+        self.cv_annotations = AnnotationIndex.load(
+            data_dir / "cv" / "annotations.json",
+            Path(constants.ANNOTATION_CACHE_DIR) / "cv_annotations.idx",
+        )
 
         self.init_testcases()
 
     def get_cv_annotation(self, img_id):
-        return {
-            "images": [self.cv_img_info[img_id]],
-            "annotations": self.cv_ann_info[img_id],
-            "categories": self.cv_categories,
-        }
+        return self.cv_annotations.get(img_id)
 
     def reset(self):
         self.queue = deque()
@@ -136,7 +86,7 @@ class TaskHandler:
                 added_count += 1
             except IndexError:
                 # presumably we ran out of stuff, oh no, whatever
-                print(f"we ran out of {task_type}")
+                logger.info(f"we ran out of {task_type}")
 
     def get_task_data(self):
         if len(self.queue) == 0 or not self.can_get_new:
@@ -152,18 +102,30 @@ class TaskHandler:
             "b64": base64.b64encode(data).decode("ascii"),
         }
 
-    def eval_task_result(
-        self, data: dict[str, str | list[list[int]]], elapsed: float
-    ) -> float:
+    def pop_task(self, data: dict[str, str | list[list[int]]]) -> Task:
+        """Removes the current task from the queue; `data` is its result."""
         if len(self.queue) == 0:
-            raise Exception("how did we eval_task_result with an empty queue?")
-        prediction = data["result"]
+            raise Exception("how did we pop_task with an empty queue?")
         # the current task is the first in the queue
         first = self.queue.popleft()
         assert (
             first["type"] == data["task"]
         ), "The wrong type of task was returned, what happened?"
+        self.can_get_new = True
+        return first
+
+    def eval_task_result(
+        self, first: Task, data: dict[str, str | list[list[int]]], elapsed: float
+    ) -> float:
+        """Scores `data` for task `first`.
+
+        Doesn't touch the queue, so it can run in a thread while the match
+        carries on.
+        """
+        prediction = data["result"]
         task_dir = self.data_dir / first["type"]
+        # imported here so jiwer and pycocotools are only loaded once scoring starts
+        import scoring
 
         match first["type"]:
             case TaskType.ASR:
@@ -171,13 +133,7 @@ class TaskHandler:
                     task_dir / first["type"].get_gt_path(first["index"]), "r"
                 ) as f:
                     contents = f.read()
-                word_output = jiwer.process_words(
-                    contents,
-                    prediction,
-                    reference_transform=wer_transforms,
-                    hypothesis_transform=wer_transforms,
-                )
-                out = 1 - word_output.wer
+                out = scoring.score_asr(contents, prediction)
 
             case TaskType.CV:
                 if not prediction:
@@ -188,26 +144,14 @@ class TaskHandler:
                     pred["score"] = 1
 
                 this_image_anns = self.get_cv_annotation(first["index"])
-                ground_truth = COCOPatched(this_image_anns)
-                results = ground_truth.loadRes(prediction)
-                coco_eval = COCOeval(ground_truth, results, "bbox")
-                coco_eval.evaluate()
-                coco_eval.accumulate()
-                coco_eval.summarize()
-                out = coco_eval.stats[0].item()  # mAP@.5:.05:.95
+                out = scoring.score_cv(this_image_anns, prediction)
 
             case TaskType.OCR:
                 with open(
                     task_dir / first["type"].get_gt_path(first["index"]), "r"
                 ) as f:
                     contents = f.read()
-                cer = jiwer.cer(
-                    contents,
-                    prediction,
-                    reference_transform=cer_transforms,
-                    hypothesis_transform=cer_transforms,
-                )
-                out = 1 - cer
+                out = scoring.score_ocr(contents, prediction)
 
         # Use elapsed time to evaluate score
         speed_score = (
@@ -215,7 +159,6 @@ class TaskHandler:
             / constants.MAX_TIME_PER_TEST_CASE
         )
         out = out * constants.PERFORMANCE_WEIGHT + speed_score * constants.SPEED_WEIGHT
-        self.can_get_new = True
         return out
 
 
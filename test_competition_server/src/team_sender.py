@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from collections import deque
+from time import time
+
+from fastapi import WebSocket
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class TeamSender:
+    """Sends messages to one team from its own task, off the shared step loop.
+
+    `send` never waits on the network. Messages go into a bounded queue that a
+    dedicated task drains, so a slow client only ever delays itself. Messages
+    sent with a `key` replace any queued message with the same key instead of
+    queueing behind it (e.g. a stale RL observation is swapped for the newest
+    one), so at most one of each is ever queued.
+
+    Other messages (scout tasks, `done`) are never dropped: losing a scout task
+    would stall the Scout's task queue for the rest of the round. If more than
+    `maxsize` of them back up, the client is too slow to keep up and its
+    connection is closed instead.
+    """
+
+    def __init__(self, team_name: str, websocket: WebSocket, maxsize: int):
+        self.team_name = team_name
+        self.websocket = websocket
+        self.maxsize = maxsize
+        # entries are [key, message] lists so keyed messages can be replaced in place
+        self.pending: deque[list] = deque()
+        self.keyed: dict[str, list] = {}
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.close_task: asyncio.Task | None = None
+
+        # metrics
+        self.sent = 0
+        # messages left unsent because the connection closed
+        self.dropped = 0
+        self.replaced = 0
+        self.overflowed = False
+        self.max_backlog = 0
+        self.send_time = 0.0
+
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, message: dict, key: str | None = None):
+        if self.closed:
+            self.dropped += 1
+            return
+        if key is not None and key in self.keyed:
+            self.keyed[key][1] = message
+            self.replaced += 1
+            return
+        if key is None and len(self.pending) - len(self.keyed) >= self.maxsize:
+            self.overflow()
+            self.dropped += 1
+            return
+        entry = [key, message]
+        self.pending.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.max_backlog = max(self.max_backlog, len(self.pending))
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                while not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                key, message = self.pending.popleft()
+                if key is not None:
+                    del self.keyed[key]
+                start_time = time()
+                await self.websocket.send_json(message)
+                self.send_time += time() - start_time
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the receive loop in team_endpoint handles the disconnect itself
+            logger.info(f"Stopped sending to team '{self.team_name}': {e!r}")
+        finally:
+            self.closed = True
+            self.dropped += len(self.pending)
+            self.pending.clear()
+            self.keyed.clear()
+
+    def overflow(self):
+        logger.warning(
+            "Closing connection to team '%s': more than %s unsent messages",
+            self.team_name,
+            self.maxsize,
+        )
+        self.overflowed = True
+        self.closed = True
+        self.task.cancel()
+        self.dropped += len(self.pending)
+        self.pending.clear()
+        self.keyed.clear()
+        # the receive loop in team_endpoint then sees the disconnect and cleans up
+        self.close_task = asyncio.create_task(self.close_websocket())
+
+    async def close_websocket(self):
+        try:
+            await self.websocket.close(code=1008, reason="Too many unsent messages")
+        except Exception:
+            # already closed from the other side
+            pass
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "replaced": self.replaced,
+            "backlog": len(self.pending),
+            "max_backlog": self.max_backlog,
+            "overflowed": self.overflowed,
+            "avg_send_time": self.send_time / self.sent if self.sent else 0.0,
+        }